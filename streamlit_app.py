@@ -1,40 +1,43 @@
 import streamlit as st
 import pandas as pd
-import plotly.graph_objects as go
-from datetime import datetime, timedelta
+import numpy as np
+import polars as pl
 import os
 import csv
+import threading
+import plotly.graph_objects as go
 
 # Page configuration
 st.set_page_config(page_title="Price History Viewer", layout="wide")
 
+# Кэши ключуются по mtime файла, поэтому после каждого обновления данных старые записи
+# больше не нужны; держим около двух поколений на каждый из ~440 предметов
+MAX_ITEM_CACHE_ENTRIES = 1000
+
+# Время изменения файла - часть ключа кэша, поэтому кэш сбрасывается только при изменении файла
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+# Каноническое имя предмета: без кавычек и пробелов по краям.
+# При загрузке картинок то же самое делает выражение в read_image_data, при поиске - эта функция
+def canonical_name(name):
+    return name.replace('"', '').strip()
+
 # Image data loading function
-@st.cache_data
-def load_image_data():
-    file_path = "data/img.csv"
-    
+@st.cache_data(max_entries=2)
+def read_image_data(file_path, mtime):
     try:
-        # Читаем файл вручную
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-            
-        img_dict = {}
-        # Пропускаем заголовок
-        for line in lines[1:]:
-            # Разделяем строку по запятой, но только на первое вхождение
-            parts = line.split(',', 1)
-            if len(parts) == 2:
-                name = parts[0].strip().strip('"')
-                url = parts[1].strip().strip('"').strip()  # Удаляем лишние пробелы и кавычки
-                
-                # Добавляем различные варианты написания имени
-                img_dict[name] = url
-                img_dict[name.strip()] = url
-                img_dict[name.replace('"', '')] = url
-                img_dict[name.lower()] = url  # Добавляем вариант в нижнем регистре
-                img_dict[name.strip().lower()] = url  # Добавляем очищенный вариант в нижнем регистре
-                
-        return img_dict
+        # Файл в кавычках, поэтому разбираем его CSV-парсером: запятые внутри имен не ломают строку.
+        # Все поля читаем как строки; имена приводим к каноническому виду (см. canonical_name)
+        # строковыми выражениями polars, без цикла по строкам в Python
+        images = pl.read_csv(file_path, infer_schema_length=0)
+        names = images.to_series(0).str.replace_all('"', '', literal=True).str.strip_chars().fill_null("")
+        urls = images.to_series(1).str.strip_chars().fill_null("")
+        
+        return dict(zip(names.to_list(), urls.to_list()))
         
     except FileNotFoundError:
         st.error(f"Файл не найден: {file_path}")
@@ -43,44 +46,214 @@ def load_image_data():
         st.error(f"Ошибка чтения файла {file_path}: {str(e)}")
         return {}
 
-@st.cache_data(ttl=60)
+def load_image_data():
+    file_path = "data/img.csv"
+    return read_image_data(file_path, get_mtime(file_path))
+
+# Explicit column types for price_history.csv: timestamp plus one float32 price per item
+def price_schema(header):
+    return {col: pl.Datetime if col == 'timestamp' else pl.Float32 for col in header}
+
+def read_header(file_path):
+    with open(file_path, 'r', encoding='utf-8', newline='') as f:
+        return tuple(next(csv.reader(f)))
+
+# Одна блокировка на процесс сервера: сессии Streamlit работают в потоках одного процесса
+@st.cache_resource
+def parquet_lock():
+    return threading.Lock()
+
+# CSV остается источником данных, а читаем его parquet-копию: она колоночная, типизированная
+# и сжатая. Копии ставится mtime исходного CSV, и она пересоздается, только если mtime разошлись
+def parquet_mirror(csv_path):
+    parquet_path = os.path.splitext(csv_path)[0] + ".parquet"
+    csv_mtime = get_mtime(csv_path)
+    if get_mtime(parquet_path) != csv_mtime:
+        with parquet_lock():
+            # Пока ждали блокировку, копию могла обновить другая сессия
+            if get_mtime(parquet_path) != csv_mtime:
+                schema = price_schema(read_header(csv_path))
+                # Временный файл свой у каждого процесса, в итоговый путь попадает только готовая копия
+                tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+                prices = pl.read_csv(csv_path, schema=schema).sort('timestamp')
+                # Пропуски храним как NaN, а не null: без маски валидности float32-колонка
+                # отдается в numpy без копирования
+                prices = prices.with_columns(pl.exclude('timestamp').fill_null(float('nan')))
+                prices.write_parquet(tmp_path, compression="zstd")
+                os.utime(tmp_path, (csv_mtime, csv_mtime))
+                os.replace(tmp_path, parquet_path)
+    return parquet_path
+
+# Временные метки и список колонок читаем отдельно от цен: схема parquet уже содержит имена колонок
+@st.cache_data(max_entries=2)
+def read_price_index(file_path, mtime):
+    parquet_path = parquet_mirror(file_path)
+    columns = list(pl.read_parquet_schema(parquet_path))
+    # parquet-копия записана отсортированной, поэтому индекс монотонный и срезы по датам - бинарный поиск
+    timestamps = pd.DatetimeIndex(pl.read_parquet(parquet_path, columns=['timestamp']).to_series().to_pandas())
+    return timestamps, columns
+
+# Цены читаем только для выбранных предметов, по одной колонке - кэш общий для разных наборов
+@st.cache_data(max_entries=MAX_ITEM_CACHE_ENTRIES)
+def read_price_column(file_path, item, mtime):
+    return pl.read_parquet(parquet_mirror(file_path), columns=[item]).to_series().to_numpy()
+
+PRICE_HISTORY_PATH = "data/price_history.csv"
+
 def load_data():
-    file_path = "data/price_history.csv"
-    last_modified = os.path.getmtime(file_path)
-    df = pd.read_csv(file_path)
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    return df, last_modified
+    last_modified = get_mtime(PRICE_HISTORY_PATH)
+    timestamps, columns = read_price_index(PRICE_HISTORY_PATH, last_modified)
+    return timestamps, columns, last_modified
 
-@st.cache_data
-def load_supply_data():
-    supply_path = "data/nft_supply_results.csv"
+@st.cache_data(max_entries=2)
+def read_supply_data(supply_path, mtime):
     try:
-        supply_df = pd.read_csv(supply_path)
-        supply_dict = dict(zip(supply_df['Item Name'], supply_df['Estimated Supply']))
+        supply = pl.read_csv(supply_path).to_dict(as_series=False)
+        supply_dict = dict(zip(supply['Item Name'], supply['Estimated Supply']))
         return supply_dict
     except FileNotFoundError:
         st.error(f"File {supply_path} not found.")
         return {}
+
+def load_supply_data():
+    supply_path = "data/nft_supply_results.csv"
+    return read_supply_data(supply_path, get_mtime(supply_path))
+
+# Срез отсортированного индекса по датам; строка даты включает весь последний день
+def date_slice(timestamps, start_date, end_date):
+    return timestamps.slice_indexer(str(start_date), str(end_date))
+
+# Скользящее среднее через накопленные суммы; как и rolling().mean(), дает NaN,
+# если в окне есть пропуски или точек меньше, чем размер окна
+def moving_average(values, window):
+    prices = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(prices)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(missing, 0.0, prices))))
+    counts = np.concatenate(([0], np.cumsum(~missing)))
+    result = np.full(prices.shape, np.nan)
+    window_sums = sums[window:] - sums[:-window]
+    full = (counts[window:] - counts[:-window]) == window
+    result[window - 1:] = np.where(full, window_sums / window, np.nan)
+    return result
+
+# Прореживание Largest-Triangle-Three-Buckets: на графике высотой 600px больше
+# ~2000 точек на линию не различить, поэтому длинные ряды не отправляем целиком
+MAX_CHART_POINTS = 2000
+
+def lttb_indices(x, y, n_out=MAX_CHART_POINTS):
+    n = len(y)
+    # Короткий ряд не прореживаем: срез дает представление массива без копии
+    if n <= n_out or n_out < 3:
+        return slice(None)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    # Первая и последняя точки сохраняются, остальные делятся на n_out - 2 корзины
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    indices = np.empty(n_out, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    prev = 0
+    for k in range(n_out - 2):
+        start, end = edges[k], edges[k + 1]
+        next_end = edges[k + 2] if k + 2 < len(edges) else n
+        next_y = y[end:next_end]
+        next_valid = ~np.isnan(next_y)
+        avg_x = x[end:next_end].mean()
+        avg_y = next_y[next_valid].mean() if next_valid.any() else y[prev]
+        area = np.abs((x[prev] - avg_x) * (y[start:end] - y[prev]) - (x[prev] - x[start:end]) * (avg_y - y[prev]))
+        # Пропуски выбираем только если вся корзина пустая, чтобы разрыв линии сохранился
+        prev = start + np.argmax(np.where(np.isnan(area), -1.0, area))
+        indices[k + 1] = prev
+    return indices
+
+# Все, что нужно для графика и статистики одного предмета за период.
+# Кэш сбрасывается при изменении файла (mtime), периода или окна скользящего среднего;
+# ma_window = 0 - скользящее среднее выключено
+@st.cache_data(max_entries=MAX_ITEM_CACHE_ENTRIES)
+def item_view(item, start_date, end_date, mtime, ma_window):
+    timestamps, _ = read_price_index(PRICE_HISTORY_PATH, mtime)
+    period = date_slice(timestamps, start_date, end_date)
+    # Целочисленное представление меток - представление тех же данных без копии, для расчетов;
+    # datetime-массив нужен только как ось X графика
+    timestamps_i8 = timestamps.asi8[period]
+    timestamps = timestamps[period].to_numpy()
+    prices = read_price_column(PRICE_HISTORY_PATH, item, mtime)[period]
+    
+    valid = prices[~np.isnan(prices)]
+    view = {
+        'start': valid[0] if valid.size else None,
+        'end': valid[-1] if valid.size else None,
+        'min': valid.min() if valid.size else None,
+        'max': valid.max() if valid.size else None,
+    }
     
-# Функция для получения последнего непустого значения
-def get_last_valid_price(df, item):
-    # Получаем все непустые значения
-    valid_prices = df[item].dropna()
-    if len(valid_prices) > 0:
-        return valid_prices.iloc[-1]
-    return None
+    shown = lttb_indices(timestamps_i8, prices)
+    view['x'], view['y'] = timestamps[shown], prices[shown]
+    if ma_window:
+        ma = moving_average(prices, ma_window)
+        shown = lttb_indices(timestamps_i8, ma)
+        view['ma_x'], view['ma_y'] = timestamps[shown], ma[shown]
+    return view
+
+# График для выбранных предметов; ma_hours = 0 - без скользящего среднего.
+# Фигура хранится через cache_resource, а не cache_data: распаковка копии из cache_data
+# заново прогнала бы валидатор plotly на каждой линии. Общий объект между сессиями не
+# меняется - st.plotly_chart только читает его через to_dict()
+@st.cache_resource(max_entries=100)
+def build_figure(items, names, start_date, end_date, mtime, ma_hours):
+    # Scattergl рисует линии через WebGL, а не SVG
+    # В plotly передаем numpy-массивы, а не Series: так он кодирует их целиком, без обхода по элементам
+    fig = go.Figure()
+    for item, name in zip(items, names):
+        view = item_view(item, start_date, end_date, mtime, ma_hours * 2)
+        fig.add_trace(go.Scattergl(
+            x=view['x'],
+            y=view['y'],
+            mode='lines',
+            name=name
+        ))
+        
+        if ma_hours:
+            fig.add_trace(go.Scattergl(
+                x=view['ma_x'],
+                y=view['ma_y'],
+                mode='lines',
+                line=dict(dash='dash'),
+                name=f'{item} MA({ma_hours}h)'
+            ))
+    
+    fig.update_layout(
+        height=600,
+        xaxis_title="Time",
+        yaxis_title="Price",
+        hovermode='x unified',
+        legend=dict(
+            yanchor="top",
+            y=0.99,
+            xanchor="left",
+            x=0.01
+        )
+    )
+    return fig
+
+# Подписи предметов с количеством; пересчитываются только при перезагрузке данных
+@st.cache_data(max_entries=2)
+def build_item_labels(columns, supply_items):
+    supply_dict = dict(supply_items)
+    items = [col for col in columns if col != 'timestamp']
+    items_with_supply = [f"{item} (Supply: {int(supply_dict.get(item, 0))})" for item in items]
+    display_to_original = dict(zip(items_with_supply, items))
+    return items, items_with_supply, display_to_original
 
 def main():
     # Load all data
-    df, _ = load_data()
+    timestamps, columns, last_modified = load_data()
     supply_dict = load_supply_data()
     img_dict = load_image_data()
     default_img = "https://i.ibb.co/tpZ9HsSY/photo-2023-12-23-09-42-33.jpg"
 
     # Проверка соответствия имен
-    items = [col for col in df.columns if col != 'timestamp']
-    items_with_supply = [f"{item} (Supply: {int(supply_dict.get(item, 0))})" for item in items]
-    display_to_original = dict(zip(items_with_supply, items))
+    items, items_with_supply, display_to_original = build_item_labels(tuple(columns), tuple(supply_dict.items()))
     
     # Sidebar with filters
     with st.sidebar:
@@ -96,9 +269,9 @@ def main():
         
         date_range = st.date_input(
             "Select period",
-            value=(df['timestamp'].min().date(), df['timestamp'].max().date()),
-            min_value=df['timestamp'].min().date(),
-            max_value=df['timestamp'].max().date()
+            value=(timestamps[0].date(), timestamps[-1].date()),
+            min_value=timestamps[0].date(),
+            max_value=timestamps[-1].date()
         )
         
         show_ma = st.checkbox("Show moving average", value=True)
@@ -119,16 +292,18 @@ def main():
 
     # Display chart and statistics
     if selected_items:
-        mask = (df['timestamp'].dt.date >= date_range[0]) & (df['timestamp'].dt.date <= date_range[1])
-        filtered_df = df.loc[mask]
+        ma_hours = ma_period if show_ma else 0
+
+        # Для одного предмета статистика уже посчитана в item_view
+        if len(selected_items) == 1:
+            item = selected_items[0]
+            view = item_view(item, date_range[0], date_range[1], last_modified, ma_hours * 2)
+            start_price, end_price = view['start'], view['end']
+            min_price, max_price = view['min'], view['max']
         
         # Теперь добавляем процентное изменение в правую колонку
         with percent_col:
             if len(selected_items) == 1:
-                item = selected_items[0]
-                start_price = filtered_df[item].dropna().iloc[0] if not filtered_df[item].dropna().empty else None
-                end_price = get_last_valid_price(filtered_df, item)
-                
                 if start_price is not None and end_price is not None:
                     percent_change = ((end_price - start_price) / start_price) * 100
                     color = "green" if percent_change >= 0 else "red"
@@ -142,60 +317,17 @@ def main():
                         """, 
                         unsafe_allow_html=True
                     )
-
-    # Check date_range
-    if len(date_range) != 2:
-        st.error("Please select two dates to define the period")
-        return
-
-    # Display chart and statistics
-    if selected_items:
-        mask = (df['timestamp'].dt.date >= date_range[0]) & (df['timestamp'].dt.date <= date_range[1])
-        filtered_df = df.loc[mask]
-        
-        fig = go.Figure()
         
-        for item in selected_items:
-            fig.add_trace(go.Scatter(
-                x=filtered_df['timestamp'],
-                y=filtered_df[item],
-                mode='lines',
-                name=f"{item} (Supply: {int(supply_dict.get(item, 0))})"
-            ))
-            
-            if show_ma:
-                window = int(ma_period * 2)
-                ma = filtered_df[item].rolling(window=window).mean()
-                fig.add_trace(go.Scatter(
-                    x=filtered_df['timestamp'],
-                    y=ma,
-                    mode='lines',
-                    line=dict(dash='dash'),
-                    name=f'{item} MA({ma_period}h)'
-                ))
-        
-        fig.update_layout(
-            height=600,
-            xaxis_title="Time",
-            yaxis_title="Price",
-            hovermode='x unified',
-            legend=dict(
-                yanchor="top",
-                y=0.99,
-                xanchor="left",
-                x=0.01
-            )
+        # Фигура собирается и проверяется только при изменении выбора, периода или данных.
+        # Сериализацию в JSON st.plotly_chart все равно выполняет на каждом перезапуске -
+        # готовую строку он принять не умеет
+        figure = build_figure(
+            tuple(selected_items), tuple(selected_items_with_supply),
+            date_range[0], date_range[1], last_modified, ma_hours
         )
-        
-        st.plotly_chart(fig, use_container_width=True)
+        st.plotly_chart(figure, use_container_width=True)
         
         if len(selected_items) == 1:
-            item = selected_items[0]
-            
-            # Calculate percentage change
-            start_price = filtered_df[item].dropna().iloc[0] if not filtered_df[item].dropna().empty else None
-            end_price = get_last_valid_price(filtered_df, item)
-
             img_col, stats_col = st.columns([0.5, 2])
             
             with img_col:
@@ -208,13 +340,8 @@ def main():
                     </style>
                     """, unsafe_allow_html=True)
                 
-                # Ищем изображение с разными вариантами очистки имени
-                item_clean = item.strip().strip('"')
-                img_url = img_dict.get(item_clean, None)
-                if img_url is None:
-                    img_url = img_dict.get(item.strip(), None)
-                if img_url is None:
-                    img_url = img_dict.get(item.replace('"', '').strip(), None)
+                # Ищем изображение по каноническому имени
+                img_url = img_dict.get(canonical_name(item))
                 if img_url is None:
                     img_url = default_img
                     st.warning(f"No image found for item: '{item}'")
@@ -226,9 +353,7 @@ def main():
                 st.subheader(f"Statistics - {item}")
                 col1, col2, col3, col4, col5 = st.columns(5)
                 
-                current_price = get_last_valid_price(filtered_df, item)
-                min_price = filtered_df[item].dropna().min() if not filtered_df[item].dropna().empty else None
-                max_price = filtered_df[item].dropna().max() if not filtered_df[item].dropna().empty else None
+                current_price = end_price
                 supply = supply_dict.get(item, 0)
                 
                 # Display metrics with responsive font size and theme-aware colors